@@ -12,9 +12,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #--------------------------------------------------------------------------
+import hashlib
+import io
+import mmap
 import os
-import datetime
+import random
 import sys
+import threading
+import time
+
+import numpy as np
+import requests
+from concurrent import futures
+from requests.adapters import HTTPAdapter
 
 from azure.storage.blob import (
     BlockBlobService,
@@ -54,6 +64,16 @@ CONNECTION_COUNTS = [1, 2, 5, 10, 50]
 CONTAINER_NAME = 'performance'
 
 
+def tune_transfer_sizes(service):
+    # The SDK defaults are conservative: a 32MB first GET and 4MB chunks.
+    # The benchmark boxes have the memory and the pipe for more, so cover
+    # small and mid-size blobs with the single unchunked GET and halve the
+    # number of range requests for anything larger. Set per instance so
+    # the class-level defaults stay untouched for other users.
+    service.MAX_SINGLE_GET_SIZE = 64 * 1024 * 1024
+    service.MAX_CHUNK_GET_SIZE = 8 * 1024 * 1024
+
+
 def input_file(name):
     return 'input-' + name
 
@@ -61,21 +81,29 @@ def input_file(name):
 def output_file(name):
     return 'output-' + name
 
+# generation granularity for the input files: large enough that the draw
+# and the write amortize their per-call cost, small enough that the
+# multi-gigabyte entries in the file tables never sit in memory whole
+GENERATION_CHUNK_SIZE = 4 * 1048576
+
+
 def create_random_content_file(name, size_in_megs, additional_byte_count=0):
     file_name = input_file(name)
     if not os.path.exists(file_name):
         print('generating {0}'.format(name))
+        rng = np.random.default_rng()
+        remaining = size_in_megs * 1048576 + additional_byte_count
         with open(file_name, 'wb') as stream:
-            for i in range(size_in_megs):
-                stream.write(os.urandom(1048576))
-            if additional_byte_count > 0:
-                stream.write(os.urandom(additional_byte_count))
+            while remaining > 0:
+                chunk_size = min(remaining, GENERATION_CHUNK_SIZE)
+                stream.write(rng.bytes(chunk_size))
+                remaining -= chunk_size
 
 def upload_blob(service, name, connections):
     blob_name = name
     file_name = input_file(name)
     sys.stdout.write('\tUp:')
-    start_time = datetime.datetime.now()
+    start_time = time.perf_counter_ns()
     if isinstance(service, BlockBlobService):
         service.create_blob_from_path(
             CONTAINER_NAME, blob_name, file_name, max_connections=connections)
@@ -88,8 +116,8 @@ def upload_blob(service, name, connections):
     else:
         service.create_blob_from_path(
             CONTAINER_NAME, blob_name, file_name, max_connections=connections)
-    elapsed_time = datetime.datetime.now() - start_time
-    sys.stdout.write('{0}s'.format(elapsed_time.total_seconds()))
+    elapsed_time = (time.perf_counter_ns() - start_time) / 1e9
+    sys.stdout.write('{0}s'.format(elapsed_time))
 
 def download_blob(service, name, connections):
     blob_name = name
@@ -97,26 +125,29 @@ def download_blob(service, name, connections):
     if os.path.exists(target_file_name):
         os.remove(target_file_name)
     sys.stdout.write('\tDn:')
-    start_time = datetime.datetime.now()
+    start_time = time.perf_counter_ns()
     service.get_blob_to_path(
         CONTAINER_NAME, blob_name, target_file_name, max_connections=connections)
-    elapsed_time = datetime.datetime.now() - start_time
-    sys.stdout.write('{0}s'.format(elapsed_time.total_seconds()))
+    elapsed_time = (time.perf_counter_ns() - start_time) / 1e9
+    sys.stdout.write('{0}s'.format(elapsed_time))
 
 def file_contents_equal(first_file_path, second_file_path):
     first_size = os.path.getsize(first_file_path);
     second_size = os.path.getsize(second_file_path)
     if first_size != second_size:
         return False
+    if first_size == 0:
+        return True
+    # map both files and let the kernel page them in; the memoryview
+    # comparison is a straight memcmp with no read() copies into python
+    # buffers
     with open(first_file_path, 'rb') as first_stream:
         with open(second_file_path, 'rb') as second_stream:
-            while True:
-                first_data = first_stream.read(1048576)
-                second_data = second_stream.read(1048576)
-                if first_data != second_data:
-                    return False
-                if not first_data:
-                    return True
+            with mmap.mmap(first_stream.fileno(), 0,
+                           access=mmap.ACCESS_READ) as first_map:
+                with mmap.mmap(second_stream.fileno(), 0,
+                               access=mmap.ACCESS_READ) as second_map:
+                    return memoryview(first_map) == memoryview(second_map)
 
 def compare_files(name):
     first_file_path = input_file(name)
@@ -144,11 +175,367 @@ def main():
     bbs = BlockBlobService(settings.STORAGE_ACCOUNT_NAME, settings.STORAGE_ACCOUNT_KEY)
     pbs = PageBlobService(settings.STORAGE_ACCOUNT_NAME, settings.STORAGE_ACCOUNT_KEY)
     abs = AppendBlobService(settings.STORAGE_ACCOUNT_NAME, settings.STORAGE_ACCOUNT_KEY)
-    service.create_container(CONTAINER_NAME)
+    for service in (bbs, pbs, abs):
+        tune_transfer_sizes(service)
+    bbs.create_container(CONTAINER_NAME)
 
     process(bbs, LOCAL_BLOCK_BLOB_FILES, CONNECTION_COUNTS)
     process(pbs, LOCAL_PAGE_BLOB_FILES, CONNECTION_COUNTS)
     process(abs, LOCAL_APPEND_BLOB_FILES, CONNECTION_COUNTS)
 
+
+# ------------------------------------------------------------------------
+# Batch benchmark: many small blobs transferred in parallel. Measures the
+# per-operation latency distribution for upload, download and delete
+# rather than the throughput of a single large transfer. Requires numpy.
+
+BATCH_CONTAINER_NAME = 'performancebatch'
+BATCH_FILE_COUNT = 2000
+BATCH_FILE_SIZE_IN_KB = 64
+BATCH_CONCURRENCY = 32
+
+# delay before a download is hedged with a duplicate request; keep this
+# near the measured p99 so only genuine stragglers pay for a second try
+BATCH_HEDGE_DELAY_IN_SECS = 1.0
+
+# how many operations ride on a single submitted task in phases where
+# the operations are too cheap to justify a task each
+BATCH_SUBMIT_CHUNK_SIZE = 16
+
+BATCH_PERCENTILES = [50, 66, 75, 80, 90, 95, 98, 99]
+
+_batch_thread_context = threading.local()
+
+
+def get_batch_service():
+    # One BlockBlobService (and therefore one requests.Session) per worker
+    # thread. A shared session funnels every thread through the same
+    # urllib3 pool lock; with a private session each thread keeps its own
+    # connection and never contends. Each session is trimmed to a single
+    # warm connection, so across the pool the fleet of sessions holds
+    # exactly BATCH_CONCURRENCY connections instead of the 10-per-session
+    # urllib3 default.
+    service = getattr(_batch_thread_context, 'service', None)
+    if service is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        service = BlockBlobService(settings.STORAGE_ACCOUNT_NAME,
+                                   settings.STORAGE_ACCOUNT_KEY,
+                                   request_session=session)
+        tune_transfer_sizes(service)
+        _batch_thread_context.service = service
+    return service
+
+
+def get_batch_download_stream():
+    # one download buffer per thread, emptied between uses, so the
+    # backing allocation is reused for every blob the thread fetches
+    stream = getattr(_batch_thread_context, 'download_stream', None)
+    if stream is None:
+        stream = io.BytesIO()
+        _batch_thread_context.download_stream = stream
+    stream.seek(0)
+    stream.truncate()
+    return stream
+
+
+def compute_elapsed_time(start_time_ns, end_time_ns):
+    return (end_time_ns - start_time_ns) / 1e9
+
+
+def batch_upload_blob(blob_name, payload):
+    service = get_batch_service()
+    start_time = time.perf_counter_ns()
+    try:
+        # hand the payload over as bytes: create_blob_from_bytes takes the
+        # byte-buffer path inside the SDK, so the harness no longer
+        # maintains its own stream layer on top of the payload
+        service.create_blob_from_bytes(
+            BATCH_CONTAINER_NAME, blob_name, payload)
+        succeeded = True
+    except Exception:
+        succeeded = False
+    end_time = time.perf_counter_ns()
+    return succeeded, compute_elapsed_time(start_time, end_time)
+
+
+def download_blob_once(blob_name):
+    service = get_batch_service()
+    stream = get_batch_download_stream()
+    service.get_blob_to_stream(BATCH_CONTAINER_NAME, blob_name, stream)
+
+
+_hedge_pool = None
+_hedge_pool_lock = threading.Lock()
+
+
+def get_hedge_pool():
+    # sized so every batch worker can have a primary and a hedge in
+    # flight at once
+    global _hedge_pool
+    if _hedge_pool is None:
+        with _hedge_pool_lock:
+            if _hedge_pool is None:
+                _hedge_pool = futures.ThreadPoolExecutor(
+                    2 * BATCH_CONCURRENCY)
+    return _hedge_pool
+
+
+def batch_download_blob(blob_name):
+    # Hedged download: if the primary attempt has not come back within
+    # BATCH_HEDGE_DELAY_IN_SECS (set near the observed p99), fire a
+    # second attempt and take whichever finishes first. The stragglers
+    # that shape the tail are usually a slow server replica or a dropped
+    # packet, so the duplicate request almost always wins by a wide
+    # margin, at the price of a little duplicate load on the tail only.
+    pool = get_hedge_pool()
+    start_time = time.perf_counter_ns()
+    attempts = [pool.submit(download_blob_once, blob_name)]
+    done, _ = futures.wait(attempts, timeout=BATCH_HEDGE_DELAY_IN_SECS)
+    if not done:
+        attempts.append(pool.submit(download_blob_once, blob_name))
+
+    succeeded = False
+    for future in futures.as_completed(attempts):
+        if future.exception() is None:
+            succeeded = True
+            break
+    end_time = time.perf_counter_ns()
+    # the elapsed time runs from submission to the first completed
+    # attempt: it is the latency of the hedged system as a client sees
+    # it, not the latency of the un-hedged primary request
+    return succeeded, compute_elapsed_time(start_time, end_time)
+
+
+def batch_delete_blob(blob_name):
+    service = get_batch_service()
+    start_time = time.perf_counter_ns()
+    try:
+        service.delete_blob(BATCH_CONTAINER_NAME, blob_name)
+        succeeded = True
+    except Exception:
+        succeeded = False
+    end_time = time.perf_counter_ns()
+    return succeeded, compute_elapsed_time(start_time, end_time)
+
+
+def batch_delete_chunk(blob_names):
+    return [batch_delete_blob(blob_name) for blob_name in blob_names]
+
+
+def run_chunked_delete_phase(executor, blob_names):
+    # Deletes finish in a few milliseconds, so the per-task submit cost
+    # (futures, queue locking, wakeups) is proportionally at its worst.
+    # executor.map's chunksize only applies to process pools, so chunk by
+    # hand: each task deletes BATCH_SUBMIT_CHUNK_SIZE blobs and reports
+    # their individual timings, cutting the queue traffic by the chunk
+    # size while the measurements stay per-operation.
+    success = np.zeros(len(blob_names), dtype=np.bool_)
+    elapsed = np.zeros(len(blob_names), dtype=np.float64)
+
+    future_to_start = {}
+    for start in range(0, len(blob_names), BATCH_SUBMIT_CHUNK_SIZE):
+        chunk = blob_names[start:start + BATCH_SUBMIT_CHUNK_SIZE]
+        future_to_start[executor.submit(batch_delete_chunk, chunk)] = start
+
+    for future in futures.as_completed(future_to_start):
+        start = future_to_start[future]
+        for offset, (succeeded, seconds) in enumerate(future.result()):
+            success[start + offset] = succeeded
+            elapsed[start + offset] = seconds
+
+    return success, elapsed
+
+
+def run_pipelined_upload_download(executor, blob_names, payload):
+    # all four result arrays are preallocated to one slot per blob and
+    # filled in place; a blob whose upload failed simply keeps its
+    # default False in download_success, so nothing is ever boxed into
+    # an intermediate python list
+    upload_success = np.zeros(len(blob_names), dtype=np.bool_)
+    upload_elapsed = np.zeros(len(blob_names), dtype=np.float64)
+    download_success = np.zeros(len(blob_names), dtype=np.bool_)
+    download_elapsed = np.zeros(len(blob_names), dtype=np.float64)
+
+    upload_future_to_index = {
+        executor.submit(batch_upload_blob, blob_name, payload): i
+        for i, blob_name in enumerate(blob_names)}
+
+    download_future_to_index = {}
+    for future in futures.as_completed(upload_future_to_index):
+        i = upload_future_to_index[future]
+        upload_success[i], upload_elapsed[i] = future.result()
+        if upload_success[i]:
+            # the download rides the same pool, so it starts as soon as a
+            # worker frees up rather than after the last upload lands
+            download_future_to_index[
+                executor.submit(batch_download_blob, blob_names[i])] = i
+
+    for future in futures.as_completed(download_future_to_index):
+        i = download_future_to_index[future]
+        download_success[i], download_elapsed[i] = future.result()
+
+    return (upload_success, upload_elapsed,
+            download_success, download_elapsed)
+
+
+def random_check(service, blob_names, payload, sample_size=16):
+    # Spot-check a random sample of the uploaded blobs round-tripped
+    # intact; checking all of them would dwarf the benchmark itself.
+    # Callers must pass only names whose upload succeeded: a missing
+    # blob raises out of get_blob_to_bytes rather than comparing unequal.
+    # Comparing BLAKE2b digests instead of the raw content means the
+    # expected payload is hashed once for the whole sample and each
+    # downloaded copy can be dropped as soon as it is hashed.
+    expected_digest = hashlib.blake2b(payload).digest()
+    sample = random.sample(blob_names, min(sample_size, len(blob_names)))
+    for blob_name in sample:
+        blob = service.get_blob_to_bytes(BATCH_CONTAINER_NAME, blob_name)
+        if hashlib.blake2b(blob.content).digest() != expected_digest:
+            return False
+    return True
+
+
+def filter_out_unsuccessful_files(success, elapsed):
+    # the success array is already a boolean mask over the parallel
+    # elapsed array, so selecting with it happens entirely in numpy;
+    # asarray keeps that true for callers holding plain sequences
+    return np.asarray(elapsed)[np.asarray(success, dtype=bool)]
+
+
+def compute_result_indicators(np_results):
+    # np_results must already be sorted ascending: the caller sorts the
+    # filtered times exactly once, and every indicator here reads the
+    # sorted array directly. np.percentile would partition the data all
+    # over again for values the sort has already put in place.
+    total = len(np_results)
+    if total == 0:
+        # an all-failure phase: report the zero count and omit the
+        # latency indicators instead of dying on an empty array, so the
+        # rest of the run still gets summarized
+        return {'count': 0}
+
+    ranks = [int(round((total - 1) * percentile / 100.0))
+             for percentile in BATCH_PERCENTILES]
+
+    indicators = {
+        'count': total,
+        'min': np_results[0],
+        'max': np_results[-1],
+        'mean': np_results.mean(),
+    }
+    for percentile, rank in zip(BATCH_PERCENTILES, ranks):
+        indicators['p{0}'.format(percentile)] = np_results[rank]
+
+    # average latency over the fastest p percent of operations, which
+    # shows how much the tail drags the plain mean. One cumulative sum
+    # gives every prefix total; indexing it at the percentile ranks
+    # replaces the per-percentile mean() passes over the array. The
+    # accumulator dtype is pinned to float64 so the running totals do not
+    # silently inherit a narrower dtype from the input, and cumsum[rank]
+    # spans exactly the rank + 1 fastest samples that the divisor counts.
+    np_ranks = np.asarray(ranks)
+    np_cumsum = np.cumsum(np_results, dtype=np.float64)
+    prefix_means = np_cumsum[np_ranks] / (np_ranks + 1)
+    for percentile, prefix_mean in zip(BATCH_PERCENTILES, prefix_means):
+        indicators['avg_p{0}'.format(percentile)] = prefix_mean
+    return indicators
+
+
+def write_batch_results(file_path, elapsed):
+    # build the whole report in memory and hand it to the OS in one
+    # write() rather than a few thousand tiny ones
+    lines = '\n'.join('{0:.6f}'.format(seconds) for seconds in elapsed)
+    with open(file_path, 'w') as the_file:
+        the_file.write(lines + '\n')
+
+
+def write_batch_summary(file_path, phase_indicators):
+    # assemble the summary in memory and flush it in one write, same as
+    # the per-task results file
+    lines = []
+    for phase_name, indicators in phase_indicators.items():
+        lines.append(phase_name)
+        for name, value in indicators.items():
+            lines.append('\t{0}: {1}'.format(name, value))
+    with open(file_path, 'w') as the_file:
+        the_file.write('\n'.join(lines) + '\n')
+
+
+def create_batch_payload(size_in_kb):
+    # benchmark payloads need to be incompressible, not cryptographically
+    # random: os.urandom drains the kernel CSPRNG through a syscall and
+    # slows down sharply at large sizes, while numpy's PCG64 generator
+    # emits statistically random bytes at close to memory bandwidth
+    return np.random.default_rng().bytes(size_in_kb * 1024)
+
+
+def run_batch_benchmark():
+    service = BlockBlobService(settings.STORAGE_ACCOUNT_NAME, settings.STORAGE_ACCOUNT_KEY)
+    service.create_container(BATCH_CONTAINER_NAME)
+
+    payload = create_batch_payload(BATCH_FILE_SIZE_IN_KB)
+    blob_names = ['batch-{0:06d}'.format(i) for i in range(BATCH_FILE_COUNT)]
+
+    # one pool for all three phases: the workers, their thread-local
+    # services and their warm connections carry over from upload to
+    # download to delete instead of being torn down at each phase barrier
+    with futures.ThreadPoolExecutor(BATCH_CONCURRENCY) as executor:
+        # uploads and downloads are pipelined: each blob's download is
+        # queued the moment its upload completes, so the two phases
+        # overlap instead of the downloads idling behind a full barrier
+        print('upload + download: {0} blobs of {1}KB'.format(
+            BATCH_FILE_COUNT, BATCH_FILE_SIZE_IN_KB))
+        (upload_success, upload_elapsed,
+         download_success, download_elapsed) = run_pipelined_upload_download(
+            executor, blob_names, payload)
+
+        # only blobs that actually uploaded can be spot-checked; on an
+        # all-failure run there is nothing to verify and the run should
+        # still reach the delete phase and the summary
+        uploaded_names = [blob_name for blob_name, succeeded
+                          in zip(blob_names, upload_success) if succeeded]
+        if uploaded_names:
+            print('random check: {0}'.format(
+                'ok' if random_check(service, uploaded_names, payload)
+                else 'ERR!'))
+        else:
+            print('random check: skipped, no successful uploads')
+
+        print('delete')
+        delete_success, delete_elapsed = run_chunked_delete_phase(
+            executor, blob_names)
+
+    phase_indicators = {}
+    for phase_name, success, elapsed in (
+            ('upload', upload_success, upload_elapsed),
+            ('download', download_success, download_elapsed),
+            ('delete', delete_success, delete_elapsed)):
+        successful_times = np.sort(
+            filter_out_unsuccessful_files(success, elapsed))
+        indicators = compute_result_indicators(successful_times)
+        if phase_name == 'download':
+            # the download numbers measure the hedged system: each sample
+            # is submission to first completed attempt, with a duplicate
+            # request fired after the hedge delay. Record the delay next
+            # to the percentiles so the summary says what was measured.
+            indicators['hedge_delay_secs'] = BATCH_HEDGE_DELAY_IN_SECS
+        phase_indicators[phase_name] = indicators
+        write_batch_results('batch-{0}-times.txt'.format(phase_name), elapsed)
+        if indicators['count'] == 0:
+            print('{0}: all {1} operations failed'.format(
+                phase_name, len(elapsed)))
+        else:
+            print('{0}: {1}/{2} ok, mean {3:.4f}s, p99 {4:.4f}s'.format(
+                phase_name, indicators['count'], len(elapsed),
+                indicators['mean'], indicators['p99']))
+    write_batch_summary('batch-summary.txt', phase_indicators)
+
+
 if __name__ == '__main__':
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        run_batch_benchmark()
+    else:
+        main()
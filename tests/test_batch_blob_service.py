@@ -0,0 +1,161 @@
+#-------------------------------------------------------------------------
+# Copyright (c) Microsoft.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from tests.batch_blob_service import (
+    BatchBlobService,
+    DEFAULT_CONCURRENT_NUM_OF_FILES,
+)
+
+
+#--Helper Classes---------------------------------------------------------------
+class RecordingBlobService(object):
+    '''
+    Stands in for BlockBlobService so the directory-level logic can be
+    exercised without an account: records every create_blob_from_path
+    call instead of performing a transfer.
+    '''
+
+    def __init__(self):
+        self.uploaded_blob_names = []
+
+    def create_blob_from_path(self, container_name, blob_name, file_path,
+                              max_connections=1):
+        self.uploaded_blob_names.append(blob_name)
+
+
+def make_batch_service(concurrent_num_of_files=2):
+    # build the instance without __init__ so no session or real
+    # BlockBlobService is ever created
+    batch_service = object.__new__(BatchBlobService)
+    batch_service.concurrent_num_of_files = concurrent_num_of_files
+    batch_service._service = RecordingBlobService()
+    batch_service._executor = ThreadPoolExecutor(concurrent_num_of_files)
+    return batch_service
+
+
+#------------------------------------------------------------------------------
+class BatchBlobServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.batch_service = make_batch_service()
+        self.directory_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.batch_service.close()
+        shutil.rmtree(self.directory_path, ignore_errors=True)
+
+    def _create_file(self, file_name, content=b'hello'):
+        file_path = os.path.join(self.directory_path, file_name)
+        with open(file_path, 'wb') as the_file:
+            the_file.write(content)
+        return file_path
+
+    #--Test cases for the defaults ---------------------------------------
+    def test_default_concurrency(self):
+        self.assertIsInstance(DEFAULT_CONCURRENT_NUM_OF_FILES, int)
+        self.assertGreaterEqual(DEFAULT_CONCURRENT_NUM_OF_FILES, 4)
+
+    #--Test cases for upload_directory -----------------------------------
+    def test_upload_directory_uploads_every_file(self):
+        self._create_file('alpha.txt')
+        self._create_file('beta.txt')
+
+        blob_names = self.batch_service.upload_directory(
+            'container', self.directory_path, prefix='pre/')
+
+        self.assertEqual(sorted(blob_names),
+                         ['pre/alpha.txt', 'pre/beta.txt'])
+        self.assertEqual(
+            sorted(self.batch_service._service.uploaded_blob_names),
+            ['pre/alpha.txt', 'pre/beta.txt'])
+
+    def test_upload_directory_skips_unchanged_files(self):
+        self._create_file('alpha.txt')
+        changed_path = self._create_file('beta.txt')
+        # keep the cache file out of the directory being synced
+        cache_file_path = self.directory_path + '.cache.json'
+        self.addCleanup(lambda: os.path.exists(cache_file_path)
+                        and os.remove(cache_file_path))
+
+        blob_names = self.batch_service.upload_directory(
+            'container', self.directory_path, cache_file_path=cache_file_path)
+        self.assertEqual(len(blob_names), 2)
+
+        # nothing changed, so a re-sync uploads nothing
+        service = self.batch_service._service
+        service.uploaded_blob_names = []
+        blob_names = self.batch_service.upload_directory(
+            'container', self.directory_path, cache_file_path=cache_file_path)
+        self.assertEqual(blob_names, [])
+        self.assertEqual(service.uploaded_blob_names, [])
+
+        # touching one file invalidates only that file's cache entry
+        future_time = time.time() + 10
+        os.utime(changed_path, (future_time, future_time))
+        blob_names = self.batch_service.upload_directory(
+            'container', self.directory_path, cache_file_path=cache_file_path)
+        self.assertEqual(blob_names, ['beta.txt'])
+
+    #--Test cases for the bounded submission window ----------------------
+    def test_iter_transfer_bounded_yields_every_result(self):
+        results = list(self.batch_service._iter_transfer_bounded(
+            [lambda i=i: i for i in range(20)]))
+        self.assertEqual(sorted(results), list(range(20)))
+
+    def test_iter_transfer_bounded_propagates_errors(self):
+        def failing_call():
+            raise ValueError('boom')
+
+        with self.assertRaises(ValueError):
+            list(self.batch_service._iter_transfer_bounded([failing_call]))
+
+    def test_iter_transfer_bounded_limits_submissions(self):
+        release = threading.Event()
+        pulled = []
+
+        def transfer_calls():
+            for i in range(20):
+                pulled.append(i)
+                yield lambda: release.wait(10)
+
+        consumer = threading.Thread(
+            target=self.batch_service._transfer_bounded,
+            args=(transfer_calls(),))
+        consumer.start()
+        try:
+            # with every task blocked, the generator is pulled once past
+            # the window (the call in hand when the window check blocks)
+            # and then stalls instead of draining all twenty entries
+            window_size = self.batch_service.concurrent_num_of_files * 2
+            deadline = time.time() + 5
+            while len(pulled) < window_size + 1 and time.time() < deadline:
+                time.sleep(0.01)
+            time.sleep(0.1)
+            self.assertEqual(len(pulled), window_size + 1)
+        finally:
+            release.set()
+            consumer.join(10)
+        self.assertEqual(len(pulled), 20)
+
+
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+#-------------------------------------------------------------------------
+# Copyright (c) Microsoft.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#--------------------------------------------------------------------------
+'''
+Watchdog for the performance scripts: samples the CPU and memory of a
+benchmark process once per second and writes the timeline to a CSV file
+when the process exits (or the optional duration runs out).
+
+    python watch_dog.py <pid> [duration_in_seconds]
+
+Plotting is left to offline tooling (a spreadsheet, or a few lines of
+matplotlib over the CSV) so the sampler itself stays lightweight.
+Requires numpy and psutil.
+'''
+import os
+import sys
+import time
+
+import numpy as np
+import psutil
+
+SAMPLE_INTERVAL = 1.0
+
+# Samples land in fixed ring buffers sized for four hours: appending to a
+# python list would allocate and box a float per sample and grow without
+# bound on long soak runs, while the rings cost a few flat buffers for the
+# whole run and simply keep the most recent window.
+RING_BUFFER_SIZE = 4 * 60 * 60
+
+CSV_FILE_NAME = 'watch_dog.csv'
+
+
+def detach():
+    # drop our own priority so the sampler never steals cycles from the
+    # benchmark it is watching; os.name is 'nt' on Windows, never
+    # 'Windows' (that string belongs to platform.system())
+    if os.name == 'nt':
+        psutil.Process().nice(psutil.IDLE_PRIORITY_CLASS)
+    else:
+        os.nice(19)
+
+
+def unroll_ring_buffer(samples, count):
+    # return the samples in chronological order; once the ring has
+    # wrapped, the oldest retained sample sits just after the write head
+    if count <= len(samples):
+        return samples[:count].copy()
+    head = count % len(samples)
+    return np.concatenate((samples[head:], samples[:head]))
+
+
+def sample_process(pid, duration=None):
+    process = psutil.Process(pid)
+    # three parallel rings: when deadlines are skipped or the ring wraps,
+    # sample index times the interval no longer equals wall-clock, so
+    # each sample carries its actual timestamp instead
+    time_samples = np.zeros(RING_BUFFER_SIZE, dtype=np.float64)
+    cpu_samples = np.zeros(RING_BUFFER_SIZE, dtype=np.float64)
+    memory_samples = np.zeros(RING_BUFFER_SIZE, dtype=np.float64)
+    count = 0
+
+    # prime cpu_percent: the first call always reports 0.0
+    process.cpu_percent(interval=None)
+
+    # schedule each sample on an absolute deadline: sleeping a flat
+    # interval after the sampling work drifts by the cost of the sampling
+    # itself, so a long run quietly takes fewer samples than it reports
+    # seconds. Missed deadlines (suspend, heavy load) are skipped rather
+    # than replayed in a burst.
+    start = time.monotonic()
+    next_deadline = start + SAMPLE_INTERVAL
+    while process.is_running():
+        now = time.monotonic()
+        if duration is not None and now - start >= duration:
+            break
+        slot = count % RING_BUFFER_SIZE
+        try:
+            # the process can exit between is_running() and these calls;
+            # that is the normal end of a run, not an error, and the
+            # samples gathered so far must survive it
+            cpu_percent = process.cpu_percent(interval=None)
+            rss = process.memory_info().rss
+        except psutil.NoSuchProcess:
+            break
+        time_samples[slot] = now - start
+        cpu_samples[slot] = cpu_percent
+        memory_samples[slot] = rss / 1048576.0
+        count += 1
+        now = time.monotonic()
+        if now > next_deadline:
+            missed = int((now - next_deadline) // SAMPLE_INTERVAL) + 1
+            next_deadline += missed * SAMPLE_INTERVAL
+        time.sleep(max(0.0, next_deadline - now))
+        next_deadline += SAMPLE_INTERVAL
+
+    return (unroll_ring_buffer(time_samples, count),
+            unroll_ring_buffer(cpu_samples, count),
+            unroll_ring_buffer(memory_samples, count))
+
+
+def write_samples_csv(time_samples, cpu_samples, memory_samples):
+    lines = ['seconds,cpu_percent,rss_mb']
+    for i in range(len(time_samples)):
+        lines.append('{0:.1f},{1:.1f},{2:.1f}'.format(
+            time_samples[i], cpu_samples[i], memory_samples[i]))
+    with open(CSV_FILE_NAME, 'w') as csv_file:
+        csv_file.write('\n'.join(lines) + '\n')
+
+
+def main():
+    if len(sys.argv) < 2:
+        print('usage: python watch_dog.py <pid> [duration_in_seconds]')
+        sys.exit(1)
+    pid = int(sys.argv[1])
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else None
+
+    detach()
+    try:
+        time_samples, cpu_samples, memory_samples = \
+            sample_process(pid, duration)
+    except psutil.NoSuchProcess:
+        print('process {0} exited before sampling started'.format(pid))
+        sys.exit(1)
+
+    write_samples_csv(time_samples, cpu_samples, memory_samples)
+    print('wrote {0} samples to {1}'.format(len(cpu_samples), CSV_FILE_NAME))
+
+
+if __name__ == '__main__':
+    main()